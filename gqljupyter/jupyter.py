@@ -20,6 +20,9 @@ https://docs.google.com/document/d/1AM3fYMsfFgz0iD0Az35SZMUVXYFd5pbi393sh3oKei0/
 """
 
 import argparse
+import atexit
+import hashlib
+import http.client
 import logging
 import os
 import re
@@ -27,9 +30,12 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.error
+import urllib.request
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Tuple
 
 Config = NamedTuple('Config', [
     ('adhoc_addr', str),
@@ -40,6 +46,32 @@ logging.basicConfig(level=logging.DEBUG)
 # The directory on adhoc to install the grail-query binary.
 INSTALL_DIR = '/home/ubuntu/.gql_install'
 
+# The path of the gqljupyter binary on adhoc.
+GQL_PATH = INSTALL_DIR + '/gqljupyter'
+
+# The S3 file that stores the sha256 of the released gqljupyter binary.
+GQL_SHA256_S3_PATH = 's3://grail-ysaito/gql/gqljupyter.sha256'
+
+# The length of a hex sha256 digest, as printed by sha256sum.
+SHA256_HEX_LEN = 64
+
+# Matches a line of "grail-adhoc status" output. Group 1 is the IP address.
+ADHOC_STATUS_RE = re.compile(r'^i-\S+\s+(\S+)')
+
+# Options for ssh and scp. The first invocation starts a master connection that
+# later invocations multiplex over, so they skip the TCP handshake and auth. The
+# socket is private to this process, so that shutting down the master at exit
+# doesn't kill the sessions of another invocation of this script.
+SSH_CONTROL_PATH = os.path.join(tempfile.gettempdir(), 'gql-ssh-%d-%%r@%%h:%%p' % (os.getpid(),))
+SSH_OPTS = ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + SSH_CONTROL_PATH,
+            '-o', 'ControlPersist=600']
+
+# Guards ssh_master_registered.
+ssh_master_lock = threading.Lock()
+# Set once close_ssh_master is registered to run at exit.
+ssh_master_registered = False
+
 def check_call(args: List[str]) -> None:
     """Run a subprocess with the given argv."""
     logging.info('Run: %s', ' '.join(args))
@@ -48,7 +80,7 @@ def check_call(args: List[str]) -> None:
 def check_output(args: List[str]) -> str:
     """Run a subprocess with the given argv and return its stdout."""
     logging.info('Run: %s', ' '.join(args))
-    return subprocess.check_output(args, universal_newlines=True)
+    return subprocess.run(args, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
 
 def install_jupyter_kernel() -> None:
     """Install the jupyter kernel config files. Jupyter must have been already installed.
@@ -97,11 +129,11 @@ def get_adhoc_addr(adhoc_name: str) -> str:
     args = ['grail-adhoc', 'status']
     if adhoc_name:
         args.append('--name=' + adhoc_name)
-    for line in check_output(args).split('\n'):
+    for line in check_output(args).splitlines():
         line = line.strip()
         if not line:
             continue
-        m = re.match(r'^i-\S+\s+(\S+)', line)
+        m = ADHOC_STATUS_RE.match(line)
         assert m, "illegal grail-adhoc status output: " + line
         ipaddrs.append(m.group(1))
     if not ipaddrs:
@@ -114,16 +146,73 @@ def get_adhoc_addr(adhoc_name: str) -> str:
 
 def ssh(config: Config, argv: List[str]) -> None:
     """Run an ssh command on the adhoc machine."""
-    check_call(['ssh', 'ubuntu@' + config.adhoc_addr] + argv)
+    check_call(['ssh'] + ssh_opts(config) + ['ubuntu@' + config.adhoc_addr] + argv)
+
+def ssh_script(config: Config, script: str) -> None:
+    """Run a shell script on the adhoc machine in a single ssh session."""
+    logging.info('Run on adhoc: %s', script)
+    subprocess.run(['ssh'] + ssh_opts(config) + ['ubuntu@' + config.adhoc_addr, 'bash', '-s'],
+                   input=script, universal_newlines=True, check=True)
+
+def ssh_opts(config: Config) -> List[str]:
+    """Return SSH_OPTS, to be passed to ssh or scp to the adhoc machine. The
+    first call arranges for the ssh master connection to be shut down at exit."""
+    global ssh_master_registered  # pylint: disable=global-statement
+    with ssh_master_lock:
+        if not ssh_master_registered:
+            atexit.register(close_ssh_master, config)
+            ssh_master_registered = True
+    return SSH_OPTS
+
+def close_ssh_master(config: Config) -> None:
+    """Shut down the ssh master connection started via SSH_OPTS, if any."""
+    subprocess.call(['ssh', '-O', 'exit', '-o', 'ControlPath=' + SSH_CONTROL_PATH,
+                     'ubuntu@' + config.adhoc_addr],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 def s3_cp(config: Config, src: str, dst: str) -> None:
     """Copy files src to dst. Either can be on S3."""
     check_call(['grail-aws', config.ticket_path, 's3', 'cp', src, dst])
 
+def s3_pipe_to_adhoc(config: Config, src: str, remote_cmd: str) -> None:
+    """Run shell command remote_cmd on the adhoc machine with the contents of S3
+    file src as its stdin. The file is not staged on the local machine."""
+    s3_args = ['grail-aws', config.ticket_path, 's3', 'cp', src, '-']
+    ssh_args = ['ssh'] + ssh_opts(config) + ['ubuntu@' + config.adhoc_addr, remote_cmd]
+    logging.info('Run: %s | %s', ' '.join(s3_args), ' '.join(ssh_args))
+    s3_proc = subprocess.Popen(s3_args, stdout=subprocess.PIPE)
+    ssh_proc = subprocess.Popen(ssh_args, stdin=s3_proc.stdout)
+    s3_proc.stdout.close()  # Let s3_proc get SIGPIPE if ssh_proc exits early.
+    ssh_status = ssh_proc.wait()
+    s3_status = s3_proc.wait()
+    if s3_status != 0:
+        raise subprocess.CalledProcessError(s3_status, s3_args)
+    if ssh_status != 0:
+        raise subprocess.CalledProcessError(ssh_status, ssh_args)
+
+def sha256_file(path: str) -> str:
+    """Return the hex sha256 digest of the local file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 def start_browser(port: int) -> None:
-    """Start a browser on localhost:port."""
-    time.sleep(1)
+    """Start a browser on localhost:port once the notebook server responds, or
+    after 30 seconds."""
     url = 'http://localhost:%d' % (port, )
+    # Probe with an HTTP request rather than a TCP connect. The ssh tunnel
+    # accepts connections before the notebook server on adhoc starts listening.
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                break
+        except urllib.error.HTTPError:
+            break  # The server is up.
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.025)
     if sys.platform.startswith('darwin'):
         check_call(['open', url])
     elif sys.platform.startswith('windows'):
@@ -131,37 +220,79 @@ def start_browser(port: int) -> None:
     else:
         check_call(['xdg-open', url])
 
-def validate_gql_binary(config: Config) -> bool:
-    """Check if gqljupyter binary on INSTALL_DIR is uptodate."""
-    gql_path = INSTALL_DIR+'/gqljupyter'
-    try:
-        got = check_output(['ssh', 'ubuntu@' + config.adhoc_addr,
-                            'sha256sum', gql_path]).split(' ')[0]
-        want = check_output(['grail-aws', config.ticket_path,
-                             's3', 'cp', 's3://grail-ysaito/gql/gqljupyter.sha256', '-']).split(' ')[0]
-        if got == want:
-            logging.info("You have the latest gqljupyter binary already")
-            return True
-        logging.error("%s on adhoc: sha256 mismatch (got %s <-> want %s)", gql_path, got, want)
-    except Exception as e:
-        logging.error("%s on adhoc: %s. Maybe you haven't installed jupyter yet? Try %s --install.",
-                      gql_path, e, __file__)
+def released_gql_sha256(config: Config) -> str:
+    """Return the sha256 of the gqljupyter binary released on S3."""
+    return check_output(['grail-aws', config.ticket_path,
+                         's3', 'cp', GQL_SHA256_S3_PATH, '-'])[:SHA256_HEX_LEN]
+
+def fetch_gql_sha256s(config: Config) -> Tuple[str, str]:
+    """Return the sha256 of the gqljupyter binary on adhoc and that of the
+    released binary. The former is '' if the binary is not installed.
+
+    Both are computed on adhoc in one ssh session, so the S3 read stays within
+    AWS. If adhoc cannot read S3 (e.g., the aws CLI is missing), the released
+    sha256 is fetched from the local machine instead."""
+    out = check_output(['ssh'] + ssh_opts(config) + [
+        'ubuntu@' + config.adhoc_addr,
+        'printf "%%s\\n%%s\\n" "$(sha256sum %s 2>/dev/null | cut -d" " -f1)" '
+        '"$(aws s3 cp %s - 2>/dev/null | cut -d" " -f1)"' % (GQL_PATH, GQL_SHA256_S3_PATH)])
+    got, want = out.splitlines()
+    if not got:
+        logging.error("%s on adhoc: not found. Maybe you haven't installed jupyter yet? Try %s --install.",
+                      GQL_PATH, __file__)
+    if not want:
+        want = released_gql_sha256(config)
+    return got, want
+
+def validate_gql_binary(got: str, want: str) -> bool:
+    """Check if gqljupyter binary on INSTALL_DIR, whose sha256 is got, is
+    uptodate. Arg want is the sha256 of the released binary."""
+    if got == want:
+        logging.info("You have the latest gqljupyter binary already")
+        return True
+    if got:
+        logging.error("%s on adhoc: sha256 mismatch (got %s <-> want %s)", GQL_PATH, got, want)
     return False
 
-def install_jupyter(config: Config) -> None:
-    """Install jupyter notebook on an adhoc machine."""
-    logging.info('Installing Jupyter and GQL')
-    ssh(config, ['sudo', 'apt', 'install', 'python3', 'libzmq3-dev'])
-    ssh(config, ['python3', '-m', 'pip', 'install', '--user', 'jupyter'])
-    check_call(['scp', __file__, 'ubuntu@%s:/tmp/install_jupyter.py' % (config.adhoc_addr, )])
+def install_jupyter_deps(config: Config) -> None:
+    """Install jupyter notebook and the GQL kernel spec on an adhoc machine."""
+    logging.info('Installing Jupyter')
+    # Copying this script doesn't depend on the packages, so overlap the two.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = [
+            pool.submit(ssh_script, config, """set -e
+sudo apt install -y python3 libzmq3-dev
+python3 -m pip install --user jupyter
+"""),
+            pool.submit(check_call, ['scp'] + ssh_opts(config) + [
+                __file__, 'ubuntu@%s:/tmp/install_jupyter.py' % (config.adhoc_addr, )])]
+        for r in results:
+            r.result()
     ssh(config, ['python3', '/tmp/install_jupyter.py', '--install-adhoc-2'])
 
-    ssh(config, ['mkdir', '-p', INSTALL_DIR])
-    s3_cp(config, 's3://grail-ysaito/gql/gqljupyter', '/tmp/gqljupyter')
-    subprocess.call(['ssh', 'ubuntu@' + config.adhoc_addr,
-                     'killall', '-9', 'gqljupyter', 'jupyter-notebook'])
-    check_call(['scp', '/tmp/gqljupyter', 'ubuntu@%s:%s/gqljupyter' % (config.adhoc_addr, INSTALL_DIR)])
-    ssh(config, ['chmod', '755', INSTALL_DIR + '/gqljupyter'])
+def install_gql_binary(config: Config) -> None:
+    """Copy the released gqljupyter binary to INSTALL_DIR on an adhoc machine."""
+    logging.info('Installing GQL')
+    # The binary is copied to a temp file, and renamed over GQL_PATH only once
+    # both ends of the copy succeeded. The rename never fails with ETXTBSY, even
+    # if the old binary is still running, and a partial copy is never installed.
+    tmp_path = GQL_PATH + '.tmp'
+    s3_pipe_to_adhoc(config, 's3://grail-ysaito/gql/gqljupyter',
+                     'mkdir -p %s && cat > %s && chmod 755 %s' % (INSTALL_DIR, tmp_path, tmp_path))
+    # Then kill the processes running the old binary. The command line of this
+    # shell contains GQL_PATH, so gqljupyter is matched by its process name, and
+    # the notebook, which runs as a python process, by a pattern anchored at the
+    # interpreter.
+    ssh(config, ['mv -f %s %s && { pkill -9 -x gqljupyter || true; } && '
+                 '{ pkill -9 -f "^[^ ]*python[^ ]* [^ ]*jupyter-notebook" || true; }'
+                 % (tmp_path, GQL_PATH)])
+
+def install_jupyter(config: Config) -> None:
+    """Install jupyter notebook and GQL on an adhoc machine. The gqljupyter
+    binary is copied only if it differs from the released one."""
+    install_jupyter_deps(config)
+    if not validate_gql_binary(*fetch_gql_sha256s(config)):
+        install_gql_binary(config)
 
 def main() -> None:
     """Main application entry point."""
@@ -188,32 +319,42 @@ def main() -> None:
     if args.release:
         if os.environ.get('USER') != 'ysaito':
             raise Exception('--release should be done only by ysaito')
-        sha256_got = check_output(['sha256sum', args.release])
+        # Same format as the output of sha256sum.
+        sha256_got = '%s  %s\n' % (sha256_file(args.release), args.release)
         with tempfile.NamedTemporaryFile(mode='w') as fd:
             fd.write(sha256_got)
             fd.flush()
-            s3_cp(config, fd.name, 's3://grail-ysaito/gql/gqljupyter.sha256')
-            s3_cp(config, args.release, 's3://grail-ysaito/gql/gqljupyter')
-            s3_cp(config, __file__, 's3://grail-ysaito/gql/jupyter.py')
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                results = [
+                    pool.submit(s3_cp, config, fd.name, GQL_SHA256_S3_PATH),
+                    pool.submit(s3_cp, config, args.release, 's3://grail-ysaito/gql/gqljupyter'),
+                    pool.submit(s3_cp, config, __file__, 's3://grail-ysaito/gql/jupyter.py')]
+                for r in results:
+                    r.result()
         sys.exit(0)
 
     if os.environ.get('USER') == 'ubuntu':
         logging.error('This script must run on your desktop/laptop, not adhoc')
         sys.exit(1)
 
-    if not validate_gql_binary(config):
-        install_jupyter(config)
-        if not validate_gql_binary(config):
+    got, want = fetch_gql_sha256s(config)
+    if not validate_gql_binary(got, want):
+        if not got:
+            # Nothing is installed yet.
+            install_jupyter_deps(config)
+        install_gql_binary(config)
+        # install_gql_binary checks the exit status of both ends of the copy,
+        # so there's no need to hash the binary again.
+        if subprocess.call(['ssh'] + ssh_opts(config) + ['ubuntu@' + config.adhoc_addr,
+                                                 'test', '-x', GQL_PATH]) != 0:
             raise Exception("Failed to install gql")
 
     subprocess.call(
-        ['ssh', 'ubuntu@' + config.adhoc_addr, "ps awx | grep jupyter | awk '{print $1}' | xargs kill -9"])
+        ['ssh'] + ssh_opts(config) + ['ubuntu@' + config.adhoc_addr, "pkill -9 -f '[j]upyter'"])
 
-    pool = ThreadPoolExecutor(max_workers=128)
-    r = pool.submit(start_browser, args.port)
+    threading.Thread(target=start_browser, args=(args.port,), daemon=True).start()
     logging.info('Starting jupyter notebook at localhost:%s', args.port)
-    subprocess.check_call([
-        'ssh',
+    subprocess.check_call(['ssh'] + ssh_opts(config) + [
         '-L', '%d:127.0.0.1:%d' % (args.port, args.port),
         'ubuntu@' + config.adhoc_addr,
         'export V23_CREDENTIALS=/home/ubuntu/.v23; ',
@@ -2,31 +2,69 @@
 """
 Utility types and functions for GQL.
 
-Requires python 3.6 and above.
+Requires python 3.8 and pandas 1.5 or above. boto3 and pyarrow are optional.
 """
 
+import concurrent.futures
+import csv
+import functools
+import http.client
+import io
 import itertools
 import logging
 import os
+import queue
 import shutil
+import socket
 import subprocess
 import tempfile
 import threading
 import time
-import csv
+import urllib.request
+import weakref
 from typing import Any, Dict, List, Optional, IO, Iterable, Tuple
 
-import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    # Optional. Tidy TSV files are parsed by pandas' own C parser without it.
+    pyarrow = None
+
+try:
+    import boto3
+    import boto3.exceptions
+    import boto3.s3.transfer
+    import boto3.session
+    import botocore.exceptions
+except ImportError:
+    # Optional. S3 files are copied with grail-file, and written via a local
+    # temp file, without it, or when it finds no AWS credentials.
+    boto3 = None
+
+# Exceptions raised by GQL.copy_file when the source cannot be read.
+_COPY_ERRORS: Tuple[type, ...] = (subprocess.CalledProcessError, FileNotFoundError)
+if boto3 is not None:
+    _COPY_ERRORS += (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError)
+
 CACHE_DIR = os.path.join('/tmp/gql_python_cache_' + os.environ['USER'])
 if not os.path.exists(CACHE_DIR):
     os.mkdir(CACHE_DIR)
 
+# Downloads into CACHE_DIR run in this pool. _downloads maps an S3 path to the
+# future of its download, so concurrent requests for the same file share one
+# download. Guarded by _downloads_lock.
+_DOWNLOAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+_downloads_lock = threading.Lock()
+_downloads: Dict[str, concurrent.futures.Future] = {}
+
 def reset_cache_dir() -> None:
     """Remove all the files in CACHE_DIR."""
     shutil.rmtree(CACHE_DIR)
     os.mkdir(CACHE_DIR)
+    _read_tidy_dictionary.cache_clear()
 
 class _S3FileWriter:
     """A writeonly file-like object that copies the contents to S3 on close."""
@@ -58,8 +96,208 @@ class _S3FileWriter:
         self.__local_fd.close()
         self.__gql.copy_file(self.__local_path, self.__s3_path)
 
+# Guards the creation of the S3 client in _s3_client, and
+# _s3_client_disabled.
+_s3_client_lock = threading.Lock()
+# Set once S3 rejects the credentials found by boto3. S3 is then accessed via
+# grail-file for the rest of the process.
+_s3_client_disabled = False
+
+@functools.lru_cache(maxsize=None)
+def _new_s3_client() -> Any:
+    """Create the boto3 S3 client. Must be called with _s3_client_lock held."""
+    if boto3 is None:
+        return None
+    # A private session, since boto3.client() uses the default session, which
+    # is not thread safe.
+    session = boto3.session.Session()
+    if session.get_credentials() is None:
+        logging.info('boto3 found no AWS credentials, accessing S3 via grail-file')
+        return None
+    return session.client('s3')
+
+def _s3_client() -> Any:
+    """Return the boto3 S3 client shared by all threads. It returns None if S3
+    must be accessed via grail-file, because boto3 is not installed, it finds
+    no AWS credentials, or S3 rejected its credentials."""
+    with _s3_client_lock:
+        if _s3_client_disabled:
+            return None
+        return _new_s3_client()
+
+def _disable_s3_client(err: Exception) -> None:
+    """Make S3 accessed via grail-file from now on, after boto3 failed with err."""
+    global _s3_client_disabled  # pylint: disable=global-statement
+    with _s3_client_lock:
+        if _s3_client_disabled:
+            return
+        _s3_client_disabled = True
+    logging.warning('boto3: %s, accessing S3 via grail-file from now on', err)
+
+def _is_boto3_auth_error(err: Exception) -> bool:
+    """Check if a boto3 error is caused by the credentials, e.g., they are
+    missing, or they belong to an AWS account that can't access the bucket but
+    grail-file's credentials may."""
+    if isinstance(err, boto3.exceptions.S3UploadFailedError):
+        # upload_file wraps the ClientError.
+        err = err.__cause__ or err.__context__  # type: ignore
+    if isinstance(err, botocore.exceptions.NoCredentialsError):
+        return True
+    return (isinstance(err, botocore.exceptions.ClientError) and
+            err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 403)
+
+def _split_s3_path(path: str) -> Tuple[str, str]:
+    """Split s3://bucket/key into (bucket, key)."""
+    assert path.startswith('s3://'), path
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+def _s3_is_older(path: str, than_path: str) -> bool:
+    """Check if S3 object path was modified before S3 object than_path. It
+    returns False if the times are unknown, because boto3 is not usable, since
+    grail-file has no stat command."""
+    client = _s3_client()
+    if client is None:
+        return False
+    try:
+        times = [client.head_object(Bucket=bucket, Key=key)['LastModified']
+                 for bucket, key in (_split_s3_path(path), _split_s3_path(than_path))]
+    except _COPY_ERRORS as e:
+        logging.info('failed to compare the times of %s and %s: %s', path, than_path, e)
+        return False
+    return times[0] < times[1]
+
+class _UploadPipe:
+    """A readonly file-like object that returns the chunks added by put(). It is
+    used as the source of a boto3 upload running in another thread.
+
+    Thread safe."""
+
+    def __init__(self) -> None:
+        # Bounded, so that a writer faster than the upload blocks instead of
+        # buffering the whole file in memory.
+        self.__queue: queue.Queue = queue.Queue(maxsize=16)
+        self.__buf = bytearray()
+        self.__eof = False
+
+    def put(self, data: bytes) -> None:
+        """Add data to the end of the stream. An empty data marks EOF."""
+        self.__queue.put(data)
+
+    def abort(self, err: Exception) -> None:
+        """Make the reader fail with err once it reaches the current end of the
+        stream."""
+        self.__queue.put(err)
+
+    def read(self, size: int = -1) -> bytes:
+        """Read implements the file-like-object interface."""
+        while not self.__eof and (size < 0 or len(self.__buf) < size):
+            data = self.__queue.get()
+            if isinstance(data, Exception):
+                self.__eof = True
+                raise data
+            if not data:
+                self.__eof = True
+                break
+            self.__buf += data
+        if size < 0 or size >= len(self.__buf):
+            out = bytes(self.__buf)
+            self.__buf.clear()
+        else:
+            out = bytes(self.__buf[:size])
+            del self.__buf[:size]
+        return out
+
+    def drain(self) -> None:
+        """Discard data until EOF, so that put() never blocks."""
+        while not self.__eof:
+            data = self.__queue.get()
+            self.__eof = not data or isinstance(data, Exception)
+
+class _S3StreamWriter:
+    """A writeonly file-like object that streams the contents to S3 using a
+    multipart upload. Unlike _S3FileWriter, the contents are not staged on the
+    local disk, and the upload overlaps with the writes."""
+
+    # Writes are coalesced into chunks of about this size before being handed to
+    # the upload thread, since callers often write one line at a time.
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path: str, client: Any) -> None:
+        self.name = path
+        self.__client = client
+        self.__buf = bytearray()
+        self.__pipe = _UploadPipe()
+        self.__err: Optional[Exception] = None
+        bucket, key = _split_s3_path(path)
+        # A daemon, so that a writer that is never closed doesn't block the
+        # interpreter exit. Such an upload is never completed, so nothing is
+        # left on S3.
+        self.__thread = threading.Thread(target=self.__upload, args=(bucket, key), daemon=True)
+        self.__thread.start()
+
+    def __upload(self, bucket: str, key: str) -> None:
+        """Upload the contents of self.__pipe. It runs in a separate thread."""
+        config = boto3.s3.transfer.TransferConfig(multipart_threshold=8 << 20,
+                                                  multipart_chunksize=8 << 20,
+                                                  max_concurrency=8,
+                                                  use_threads=True)
+        try:
+            self.__client.upload_fileobj(Fileobj=self.__pipe, Bucket=bucket, Key=key,
+                                         Config=config)
+        except Exception as e:  # pylint: disable=broad-except
+            if _is_boto3_auth_error(e):
+                # Let later files be written via grail-file.
+                _disable_s3_client(e)
+            self.__err = e
+            self.__pipe.drain()
+
+    def __enter__(self) -> Any:
+        """Implemens the context interface."""
+        return self
+
+    def __exit__(self, exc_type, excalue, traceback) -> bool:
+        """Implemens the context interface."""
+        if traceback is not None:
+            # Fail the upload, so that a partial file isn't left on S3.
+            self.__pipe.abort(Exception(f'{self.name}: write aborted'))
+            self.__thread.join()
+            return False
+        self.close()
+        return False
+
+    def write(self, data: str) -> None:
+        """Write implements the file-like-object interface."""
+        self.__buf += data.encode('utf-8')
+        if len(self.__buf) >= _S3StreamWriter.BUFFER_SIZE:
+            self.__flush()
+
+    def __flush(self) -> None:
+        """Hand the buffered data to the upload thread."""
+        if self.__buf:
+            self.__pipe.put(bytes(self.__buf))
+            self.__buf.clear()
+
+    def close(self) -> None:
+        """Close implements the file-like-object interface."""
+        self.__flush()
+        self.__pipe.put(b'')
+        self.__thread.join()
+        if self.__err is not None:
+            raise self.__err
+
+def _num_leading_comment_lines(path: str) -> int:
+    """Count the comment and empty lines at the beginning of a TSV file."""
+    n = 0
+    with open(path) as fd:
+        for line in fd:
+            if line[:1] != '#' and line.strip():
+                break
+            n += 1
+    return n
+
 def _comment_stripper(it: Iterable[str]) -> Iterable[str]:
-    "Remove CSV comment lines"
+    "Remove CSV comment lines, empty lines, and the header line"
     n = 0
     for line in it:
         if line[:1] == '#':
@@ -68,10 +306,38 @@ def _comment_stripper(it: Iterable[str]) -> Iterable[str]:
             continue
         n += 1
         if n == 1:
-            # The first line is a comment
+            # The first line is the header
             continue
         yield line
 
+@functools.lru_cache(maxsize=None)
+def _build_targets(*targets: str) -> Tuple[str, ...]:
+    """Build the bazel targets in $GRAIL in one bazel invocation, and return the
+    absolute paths of their output files, in the same order as targets. The
+    result is memoized, so the build runs once per process no matter how many
+    GQL objects are created.
+
+    The build uses a disk cache in ~/.cache/bazel-gql, so that it is fast even
+    when the bazel server restarts. If $GQL_BAZEL_REMOTE_CACHE is set, it is
+    also used as the bazel remote cache.
+
+    """
+    grail = os.environ['GRAIL']
+    cache_flags = ['--disk_cache=' + os.path.expanduser('~/.cache/bazel-gql')]
+    remote_cache = os.environ.get('GQL_BAZEL_REMOTE_CACHE')
+    if remote_cache:
+        cache_flags.append('--remote_cache=' + remote_cache)
+    subprocess.check_call(['bazel', 'build', '--noshow_progress', '--show_result=0'] +
+                          cache_flags + list(targets),
+                          cwd=grail)
+    paths: List[str] = []
+    for target in targets:
+        # The paths are relative to the workspace root.
+        out = subprocess.check_output(['bazel', 'cquery', '--noshow_progress', '--output=files', target],
+                                      cwd=grail, universal_newlines=True)
+        paths.append(os.path.join(grail, out.split()[0]))
+    return tuple(paths)
+
 class GQL:
     """This object defines methods for invoking GQL.
 
@@ -82,7 +348,8 @@ class GQL:
                  default_flags: List[str] = [],
                  default_params: Dict[str, str] = {},
                  default_max_retries=1) -> None:
-        """The constructor compiles gql using bazel."
+        """The constructor compiles gql using bazel. See _build_targets for the
+        caches used by the build.
 
         Args:
 
@@ -97,25 +364,10 @@ class GQL:
 
         """
 
-        # Build grail-query.
-        temp = tempfile.NamedTemporaryFile(mode='w', delete=False)
-        temp.close()
-        subprocess.check_call(['bazel', 'run',
-                               f'--script_path={temp.name}',
-                               '--noshow_progress',
-                               '--show_result=0',
-                               'go/src/grail.com/cmd/grail-query:grail-query'],
-                              cwd=os.environ['GRAIL'])
-        self.__gql_path = temp.name
-
-        temp = tempfile.NamedTemporaryFile(mode='w', delete=False)
-        temp.close()
-        subprocess.check_call(['bazel', 'run', f'--script_path={temp.name}',
-                               '--noshow_progress',
-                               '--show_result=0',
-                               'go/src/grail.com/cmd/grail-file:grail-file'],
-                              cwd=os.environ['GRAIL'])
-        self.__grail_file_path = temp.name
+        # Build grail-query and grail-file.
+        self.__gql_path, self.__grail_file_path = _build_targets(
+            '//go/src/grail.com/cmd/grail-query:grail-query',
+            '//go/src/grail.com/cmd/grail-file:grail-file')
         self.__default_flags = default_flags
         self.__default_params = default_params
         self.__default_max_retries = default_max_retries
@@ -249,13 +501,40 @@ class GQL:
             raise
 
     def copy_file(self, from_path: str, to_path: str):
-        "Copy a file from_path to to_path as-is. Path can be a local or a S3 file."
+        """Copy a file from_path to to_path as-is. Path can be a local or a S3 file.
+
+        If boto3 is available and exactly one of the paths is on S3, the copy is
+        done in-process. Otherwise it runs grail-file. It also falls back to
+        grail-file if boto3 has no AWS credentials, or S3 rejects them with 403,
+        e.g., because they belong to another account.
+
+        """
         logging.info('cp %s -> %s', from_path, to_path)
         try:
+            from_s3 = from_path.startswith('s3://')
+            client = _s3_client() if from_s3 != to_path.startswith('s3://') else None
+            if client is not None:
+                try:
+                    if from_s3:
+                        bucket, key = _split_s3_path(from_path)
+                        client.download_file(bucket, key, abspath(to_path))
+                    else:
+                        bucket, key = _split_s3_path(to_path)
+                        client.upload_file(abspath(from_path), bucket, key)
+                    return
+                except (botocore.exceptions.NoCredentialsError,
+                        botocore.exceptions.ClientError,
+                        boto3.exceptions.S3UploadFailedError) as e:
+                    if not _is_boto3_auth_error(e):
+                        raise
+                    logging.info('cp %s -> %s: %s, retrying with grail-file',
+                                 from_path, to_path, e)
+                    _disable_s3_client(e)
             subprocess.check_call(
                 [self.__grail_file_path, 'cp', abspath(from_path), abspath(to_path)])
-        finally:
+        except:
             _removeall(to_path)
+            raise
 
     def file_exists(self, path: str) -> bool:
         """Check if the file exists. The path can refer to a local file or an S3 object."""
@@ -263,8 +542,8 @@ class GQL:
             unused_fd = self.open_file(path)
             unused_fd.close()
             return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            # grail-file non-zero exit
+        except _COPY_ERRORS:
+            # grail-file non-zero exit, or a boto3 error.
             return False
 
     def open_file(self, path: str) -> IO[str]:
@@ -277,12 +556,16 @@ class GQL:
 
     def create_file(self, path: str) -> IO[str]:
         """Open a file for writing. The path can be either S3 or a local file. If the
-        path refers to an S3 object, contents are first written to a local temp
-        file, then copied to S3 on close.
+        path refers to an S3 object, contents are streamed to S3 if boto3 is
+        available and has AWS credentials. Otherwise they are first written to a
+        local temp file, then copied to S3 on close.
 
         """
 
         if path.startswith('s3://'):
+            client = _s3_client()
+            if client is not None:
+                return _S3StreamWriter(path, client)  # type: ignore
             return _S3FileWriter(self, path)  # type: ignore
         return open(path, 'w')
 
@@ -296,27 +579,114 @@ class GQL:
         if path.startswith('s3://'):
             local_path = os.path.join(CACHE_DIR, path.replace('/', '_'))
             if not os.path.exists(local_path):
-                self.copy_file(path, local_path)
+                self.__download(path, local_path).result()
             path = local_path
         return path
 
-    def open_tsv(self, path: str) -> Iterable[List[str]]:
-        """Create a CSV reader for the given path. The path can be an S3 object.  It
-        also strips comment lines.
+    def prefetch(self, paths: List[str]) -> None:
+        """Start downloading S3 files into the cache in the background, so that later
+        maybe_cache_file (and open_file, etc.) calls on them don't block as long.
+        Non-S3 paths are ignored. This function does not wait for the downloads.
 
         """
 
+        for path in paths:
+            if path.startswith('s3://'):
+                local_path = os.path.join(CACHE_DIR, path.replace('/', '_'))
+                if not os.path.exists(local_path):
+                    self.__download(path, local_path)
+
+    def __download(self, path: str, local_path: str) -> concurrent.futures.Future:
+        """Start copying S3 file path to local_path in _DOWNLOAD_POOL, unless the copy
+        is already running. Returns the future of the copy."""
+        with _downloads_lock:
+            future = _downloads.get(path)
+            if future is None or future.done():
+                future = _DOWNLOAD_POOL.submit(self.__copy_file_atomic, path, local_path)
+                _downloads[path] = future
+            return future
+
+    def __copy_file_atomic(self, from_path: str, to_path: str) -> None:
+        """Similar to copy_file, but to_path, which must be local, appears only once
+        the copy is complete. A concurrent reader, or a later run after an
+        interrupted copy, never sees a partial file."""
+        temp_path = f'{to_path}.tmp.{os.getpid()}.{threading.get_ident()}'
+        self.copy_file(from_path, temp_path)
+        os.replace(temp_path, to_path)
+
+    def open_tsv(self, path: str) -> Iterable[Tuple[str, ...]]:
+        """Read the rows of the given TSV file as tuples of strings. The path can be
+        an S3 object. Comment lines, empty lines, and the header line are
+        skipped.
+
+        """
+
+        path = self.maybe_cache_tsv(path)
+        logging.info("Reading %s", path)
+        try:
+            df = pd.read_csv(path,
+                             sep='\t',
+                             engine='c',
+                             skiprows=_num_leading_comment_lines(path),
+                             skip_blank_lines=True,
+                             header=0,
+                             dtype=str,
+                             na_filter=False)
+        except pd.errors.EmptyDataError:
+            # The file has no header line.
+            return []
+        except pd.errors.ParserError:
+            # Rows with more fields than the header, e.g., a comment line in the
+            # middle of the file that contains tabs.
+            with open(path) as fd:
+                return [tuple(row) for row in
+                        csv.reader(_comment_stripper(fd), delimiter='\t')]
+        # Comment lines in the middle of the file.
+        comments = df.iloc[:, 0].str.startswith('#')
+        if comments.any():
+            df = df[~comments]
+        return df.itertuples(index=False, name=None)
+
+    def maybe_cache_tsv(self, path: str) -> str:
+        """Similar to maybe_cache_file, but if the path is a *.btsv file, it also
+        translates the file into a local *.tsv file and returns its path.
+
+        If the path is an S3 *.btsv file, the translation is written next to it
+        on S3, foo.btsv becoming foo.tsv, so that other processes can reuse it.
+        If that file already exists and is newer than the btsv file, it is
+        downloaded without running the translator. The times are compared only
+        if boto3 is usable. Otherwise an existing tsv file is always reused.
+        If the tsv file cannot be written, e.g., because the bucket is read-only,
+        the btsv file is downloaded and translated locally in CACHE_DIR.
+
+        """
+
+        if path.startswith('s3://') and path.endswith('.btsv'):
+            tsv_path = path[:-len('.btsv')] + '.tsv'
+            try:
+                if not self.file_exists(tsv_path) or _s3_is_older(tsv_path, path):
+                    self.__translate_btsv(path, tsv_path)
+                    # Drop the cached copy of an old translation.
+                    _removeall(os.path.join(CACHE_DIR, tsv_path.replace('/', '_')))
+                return self.maybe_cache_file(tsv_path)
+            except subprocess.CalledProcessError as e:
+                logging.warning('failed to translate %s on S3 (%s), translating locally',
+                                path, e)
+
         path = self.maybe_cache_file(path)
         if path.endswith('.btsv'):
             tsv_path = path.replace('.btsv', '.tsv')
             if not os.path.exists(tsv_path):
-                logging.info('translate %s -> %s', path, tsv_path)
-                subprocess.check_call([
-                    'grail-query', '-overwrite-files', '-eval',
-                    f'read(`{path}`) | write(`{tsv_path}`)'])
+                self.__translate_btsv(path, tsv_path)
             path = tsv_path
-        logging.info("Reading %s", path)
-        return csv.reader(_comment_stripper(open(path)), delimiter='\t')
+        return path
+
+    def __translate_btsv(self, btsv_path: str, tsv_path: str) -> None:
+        """Translate a btsv file into a tsv file. Either path can be on S3."""
+        logging.info('translate %s -> %s', btsv_path, tsv_path)
+        subprocess.check_call([
+            self.__gql_path, '-overwrite-files', '-eval',
+            f'read(`{btsv_path}`) | write(`{tsv_path}`)'])
 
     def tidytsv_to_dataframe(self, path: str) -> pd.DataFrame:
         """Load a tidy tsv file into a pandas.DataFrame.  There must be two files: the
@@ -359,6 +729,13 @@ def abspath(path: str) -> str:
         return path
     return os.path.abspath(path)
 
+def _alloc_free_port() -> int:
+    """Return a TCP port that is currently unused. The port is picked by the OS, so
+    concurrent callers get distinct ports."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
 class _Instance:
     """Class for running one instance of gql.
 
@@ -410,13 +787,11 @@ class _Instance:
         self.gql_flags = gql_flags
         self.gql_params = gql_params
         self.max_retries = max_retries
-        self.done = False
-        self.done_cv = threading.Condition()
+        self.done = threading.Event()
         self.main_thread: Optional[threading.Thread] = None
         self.status = 0
 
-        self.bm_pprof_thread: Optional[threading.Thread] = None
-        self.main_pprof_thread: Optional[threading.Thread] = None
+        self.pprof_thread: Optional[threading.Thread] = None
 
     def run(self) -> int:
         """Run the GQL process. It blocks until the process finishes.
@@ -425,8 +800,8 @@ class _Instance:
         """
 
         log_path = self.log_prefix + "log.txt"
-        bm_port = 2000 + hash(log_path) % 20000
-        main_port = 22000 + hash(log_path) % 20000
+        bm_port = _alloc_free_port()
+        main_port = _alloc_free_port()
         self.__start_pprof(bm_port, main_port)
 
         log_out = open(log_path, 'wb')
@@ -438,7 +813,7 @@ class _Instance:
             #'--on-demand',
             #'--ec2machineimmortal',
         ]
-        gql_params = [f'--{k}={v}' for k, v in self.gql_params]
+        gql_params = [f'--{k}={v}' for k, v in self.gql_params.items()]
         cmdline = [self.gql.gql_path()] + gql_flags + [self.script_path] + gql_params
         retries = 0
         while retries <= self.max_retries:
@@ -454,51 +829,52 @@ class _Instance:
         return self.status
 
     def __start_pprof(self, bm_port: int, main_port: int) -> None:
-        """Start background threads that periodically runs pprof on the gql process."""
-        self.bm_pprof_thread = threading.Thread(
-            target=self.__pprof,
-            args=(self.log_prefix + 'bm', f'localhost:{bm_port}/debug/bigmachine/pprof'))
-        self.bm_pprof_thread.start()
-        self.main_pprof_thread = threading.Thread(
+        """Start a background thread that periodically runs pprof on the gql process."""
+        self.pprof_thread = threading.Thread(
             target=self.__pprof,
-            args=(self.log_prefix + 'main', f'localhost:{main_port}/debug/pprof'))
-        self.main_pprof_thread.start()
+            args=([(self.log_prefix + 'bm', f'localhost:{bm_port}/debug/bigmachine/pprof'),
+                   (self.log_prefix + 'main', f'localhost:{main_port}/debug/pprof')],))
+        self.pprof_thread.start()
 
     def __join_pprof(self) -> None:
-        """Stop and cull the pprof threads started by __start_pprof."""
-        with self.done_cv:
-            self.done = True
-            self.done_cv.notify_all()
-        assert self.bm_pprof_thread and self.main_pprof_thread
-        self.bm_pprof_thread.join()
-        self.main_pprof_thread.join()
-
-    def __wait_pprof_timeout(self) -> bool:
-        with self.done_cv:
-            self.done_cv.wait(30)
-            return not self.done
-
-    def __pprof(self, prefix: str, uri: str) -> None:
-        "A daemon thread that issues 'go tool pprof' periodically on the gql bigslice master."
+        """Stop and cull the pprof thread started by __start_pprof."""
+        self.done.set()
+        assert self.pprof_thread
+        self.pprof_thread.join()
+
+    def __pprof(self, targets: List[Tuple[str, str]]) -> None:
+        """A daemon thread that fetches pprof profiles periodically from the gql
+        bigslice master. Each element of targets is a (profile path prefix,
+        pprof URI) pair. The cpu and heap profiles of all the targets are
+        fetched concurrently."""
         seq = 0
         log_path = self.log_prefix + 'pprof_log.txt'
-        with open(log_path, 'w') as log_fd:
-            while self.__wait_pprof_timeout():
-                cpu_prof_path = f'{prefix}_cpu.{seq}.pprof'
-                heap_prof_path = f'{prefix}_heap.{seq}.pprof'
-                with open(cpu_prof_path, 'wb') as fd:
-                    subprocess.call(
-                        ['go', 'tool', 'pprof', '-proto',
-                         f'{uri}/profile'],
-                        stdout=fd, stderr=log_fd)
-                with open(heap_prof_path, 'wb') as fd:
-                    subprocess.call(
-                        ['go', 'tool', 'pprof', '-proto',
-                         f'{uri}/heap'],
-                        stdout=fd, stderr=log_fd)
-                time.sleep(30)
+        with open(log_path, 'w') as log_fd, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=2 * len(targets)) as pool:
+            while not self.done.wait(30):
+                futures: List[concurrent.futures.Future] = []
+                for prefix, uri in targets:
+                    futures.append(pool.submit(_Instance.__run_pprof,
+                                               f'{uri}/profile?seconds=30',
+                                               f'{prefix}_cpu.{seq}.pprof', log_fd))
+                    futures.append(pool.submit(_Instance.__run_pprof,
+                                               f'{uri}/heap', f'{prefix}_heap.{seq}.pprof', log_fd))
+                concurrent.futures.wait(futures)
                 seq += 1
 
+    @staticmethod
+    def __run_pprof(uri: str, prof_path: str, log_fd: IO[str]) -> None:
+        """Fetch the profile at the uri and store it in prof_path. The pprof
+        handlers already serve gzipped profile protos, the same as what
+        'go tool pprof -proto' would produce, so the response body is stored
+        as is."""
+        try:
+            with urllib.request.urlopen(f'http://{uri}', timeout=90) as resp, \
+                 open(prof_path, 'wb') as fd:
+                shutil.copyfileobj(resp, fd)
+        except (OSError, http.client.HTTPException) as e:
+            print(f'{uri}: {e}', file=log_fd, flush=True)
+
 def send_mail(subject: str, msg: str) -> None:
     """Send email to $USER with the given subject and message"""
     to = os.environ['USER'] + '@grailbio.com'
@@ -520,6 +896,25 @@ def _tidy_data_dictionary_path(tsv_path: str) -> str:
     assert ext == ".tsv"
     return base + "_data_dictionary.tsv"
 
+@functools.lru_cache(maxsize=128)
+def _read_tidy_dictionary(q_ref: 'weakref.ReferenceType[GQL]',
+                          tsv_path: str,
+                          mtime_ns: Optional[int]) -> Tuple[Tuple[str, Any], ...]:
+    """Parse the tidy dictionary TSV file of tsv_path into (column name, pandas
+    dtype)s. The results are cached, since the dictionary is read every time
+    the tsv file is loaded. The GQL object is passed as a weak reference so that
+    the cache doesn't keep it alive. mtime_ns is the modification time of a
+    local dictionary file, or None for S3. It is used only as part of the cache
+    key, so that a file rewritten by GQL.run is read again. The cache is also
+    cleared by reset_cache_dir and when a tidy tsv file is written."""
+    del mtime_ns  # Only used as the cache key.
+    q = q_ref()
+    assert q is not None
+    cols: List[Tuple[str, Any]] = []
+    for row in q.open_tsv(_tidy_data_dictionary_path(tsv_path)):
+        cols.append((row[0], _TidyTSVParser.parse_type(row[1])))
+    return tuple(cols)
+
 class _TidyTSVParser:
     """Helper for loading a tidy TSV file into Pandas dataframe.
 
@@ -530,61 +925,116 @@ class _TidyTSVParser:
         self.__gql = q
 
     @staticmethod
-    def parse_type(name: str) -> np.dtype:
-        """Convert tidy data type to numpy.dtype. Unsupported data types are treated as
-        just 'object's."""
+    def parse_type(name: str) -> Any:
+        """Convert tidy data type to a pandas dtype. Unsupported data types are treated
+        as just 'string's.
+
+        The types are pandas' nullable extension types, since numpy ints cannot
+        represent NA. Page
+        https://pandas.pydata.org/pandas-docs/stable/user_guide/missing_data.html
+        discusses Pandas's support for NA.
+
+        """
         if name == 'int':
-            return np.int
+            return 'Int64'
         elif name == 'float':
-            return np.float
+            return 'Float64'
         else:
-            return object
+            return 'string'
 
     @staticmethod
-    def __hack_na(row: List[str], cols: List[Tuple[str, np.dtype]]) -> List[Any]:
-        """Convert occurrences of "NA" in the row to something that Pandas can understand.
+    def arrow_type(dtype: Any) -> Any:
+        """Convert a pandas dtype returned by parse_type to pyarrow.DataType."""
+        if dtype == 'Int64':
+            return pyarrow.int64()
+        if dtype == 'Float64':
+            return pyarrow.float64()
+        return pyarrow.string()
 
-        Page https://pandas.pydata.org/pandas-docs/stable/missing_data.html
-        discusses Pandas's support for NA in general.
-
-        As of 2018/08, Pandas doesn't support NA for integers. Page
-        https://stackoverflow.com/questions/21287624/convert-pandas-column-containing-nans-to-dtype-int
-        discusses various workarouds.
+    @staticmethod
+    def __read_arrow(path: str, skip_rows: int, cols: List[Tuple[str, Any]]) -> pd.DataFrame:
+        """Read a tidy TSV file using pyarrow's multithreaded CSV parser. The first
+        skip_rows lines of the file are ignored. The result is the same as
+        that of pandas.read_csv in read()."""
+        table = pyarrow.csv.read_csv(
+            path,
+            read_options=pyarrow.csv.ReadOptions(
+                block_size=8 << 20,
+                skip_rows=skip_rows,
+                column_names=[col_name for col_name, _ in cols]),
+            parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={col_name: _TidyTSVParser.arrow_type(col_type)
+                              for col_name, col_type in cols},
+                null_values=['NA'],
+                strings_can_be_null=True))
+        return table.to_pandas(types_mapper={
+            pyarrow.int64(): pd.Int64Dtype(),
+            pyarrow.float64(): pd.Float64Dtype(),
+            pyarrow.string(): pd.StringDtype()}.get)
 
-        """
+    @staticmethod
+    def __read_pandas(source: Any, skip_rows: int, cols: List[Tuple[str, Any]]) -> pd.DataFrame:
+        """Read a tidy TSV file or a file-like object using pandas' C parser. The
+        first skip_rows lines are ignored, and the next line is replaced by the
+        column names in cols."""
+        return pd.read_csv(source,
+                           sep='\t',
+                           engine='c',
+                           skiprows=skip_rows,
+                           header=0,
+                           names=[col_name for col_name, _ in cols],
+                           dtype={col_name: col_type for col_name, col_type in cols},
+                           na_values=['NA'],
+                           keep_default_na=False)
 
-        parsed: List[Any] = []
-        for i, v in enumerate(row):
-            if v != 'NA':
-                parsed.append(v)
-                continue
-            if cols[i][1] == np.float:
-                parsed.append(np.nan)
-            elif cols[i][1] == np.int:
-                parsed.append(-9999999)
-            else:
-                parsed.append(None)
-        return parsed
-
-    def __read_dictionary(self, tsv_path: str) -> List[Tuple[str, np.dtype]]:
-        """Parse a tidy dictionary TSV file into a list of (column name, numpy
-        type)s."""
-        cols: List[Tuple[str, np.dtype]] = []
-        n = 0
-        for row in self.__gql.open_tsv(_tidy_data_dictionary_path(tsv_path)):
-            n += 1
-            #if n == 1:  # 1st row list columns.
-            #    continue
-            cols.append((row[0], _TidyTSVParser.parse_type(row[1])))
-        return cols
+    @staticmethod
+    def __drop_comment_rows(df: pd.DataFrame) -> pd.DataFrame:
+        """Remove the rows parsed from comment lines after the header. Such a line
+        parses without an error only if the first column is a string."""
+        if len(df.columns) == 0 or not pd.api.types.is_string_dtype(df.dtypes.iloc[0]):
+            return df
+        comments = df.iloc[:, 0].str.startswith('#').fillna(False).astype(bool)
+        if not comments.any():
+            return df
+        return df[~comments].reset_index(drop=True)
+
+    def __read_dictionary(self, tsv_path: str) -> List[Tuple[str, Any]]:
+        """Parse a tidy dictionary TSV file into a list of (column name, pandas
+        dtype)s."""
+        dictionary_path = _tidy_data_dictionary_path(tsv_path)
+        mtime_ns = None
+        if not dictionary_path.startswith('s3://'):
+            mtime_ns = os.stat(dictionary_path).st_mtime_ns
+        return list(_read_tidy_dictionary(weakref.ref(self.__gql), tsv_path, mtime_ns))
 
     def read(self, tsv_path: str) -> pd.DataFrame:
         """Read a tidy TSV file into a new dataframe."""
         cols = self.__read_dictionary(tsv_path)
-        rows = [_TidyTSVParser.__hack_na(row, cols) for row in self.__gql.open_tsv(tsv_path)]
-        df = pd.DataFrame(rows, columns=[col[0] for col in cols])
-        df = df.astype({col_name:col_type for col_name, col_type in cols})
-        return df
+        path = self.__gql.maybe_cache_tsv(tsv_path)
+        logging.info("Reading %s", path)
+        # The first non-comment line lists the column names. It is replaced
+        # by the names in the dictionary.
+        skip_rows = _num_leading_comment_lines(path)
+        if pyarrow is not None:
+            try:
+                df = _TidyTSVParser.__read_arrow(path, skip_rows + 1, cols)
+                return _TidyTSVParser.__drop_comment_rows(df)
+            except pyarrow.ArrowInvalid:
+                # E.g., the file has no header line. pyarrow rejects such a
+                # file, whereas pandas returns an empty dataframe.
+                logging.info("%s: pyarrow failed to parse, retrying with pandas", path)
+        try:
+            df = _TidyTSVParser.__read_pandas(path, skip_rows, cols)
+            return _TidyTSVParser.__drop_comment_rows(df)
+        except ValueError:
+            # Comment lines after the header, which neither parser can skip
+            # without also truncating values that contain '#'. Parse again
+            # without them.
+            logging.info("%s: failed to parse, retrying without comment lines", path)
+            with open(path) as fd:
+                text = ''.join(line for line in fd if line[:1] != '#')
+            return _TidyTSVParser.__read_pandas(io.StringIO(text), 0, cols)
 
 class _TidyTSVWriter:
     """Helper for writing Pandas dataframeloading as a tidy TSV file.
@@ -592,37 +1042,37 @@ class _TidyTSVWriter:
     TODO(saito): Parse time and enum types. They are currently parsed as strings.
     """
 
+    # The number of rows to format per write call.
+    CHUNK_ROWS = 4096
+
     def __init__(self, q: GQL) -> None:
         self.__gql = q
 
     @staticmethod
-    def numpy_type_to_tidy(t: np.dtype) -> str:
-        """Convert tidy data type to numpy.dtype. Unsupported data types are treated as
-        just 'object's."""
-        if t == np.int:
+    def numpy_type_to_tidy(t: Any) -> str:
+        """Convert numpy or pandas dtype to a tidy data type. Unsupported data types
+        are treated as just 'string's."""
+        if pd.api.types.is_integer_dtype(t):
             return 'int'
-        if t == np.float:
+        if pd.api.types.is_float_dtype(t):
             return 'float'
         return 'string'
 
-    @staticmethod
-    def numpy_value_to_tidy(v: Any) -> str:
-        """Convert a numby scalar value to a tidy column value."""
-        if v in (None, -9999999) or (isinstance(v, float) and np.isnan(v)):
-            return "NA"
-        return f'{v}'
-
     def write(self, df: pd.DataFrame, tsv_path: str) -> None:
         """Write a dataframe to a tidy TSV file."""
 
+        dictionary = pd.DataFrame({
+            'column_name': df.columns,
+            'type': [_TidyTSVWriter.numpy_type_to_tidy(col_type) for col_type in df.dtypes],
+            'description': 'Unknown'})
         with self.__gql.create_file(_tidy_data_dictionary_path(tsv_path)) as fd:
-            print('column_name\ttype\tdescription', file=fd)
-            for col_name, col_type in zip(df.columns, df.dtypes):
-                tidy_type = _TidyTSVWriter.numpy_type_to_tidy(col_type)
-                print(f'{col_name}\t{tidy_type}\tUnknown', file=fd)
+            fd.write(dictionary.to_csv(sep='\t', index=False, lineterminator='\n'))
+        _read_tidy_dictionary.cache_clear()
 
+        # to_csv(fd) would call fd.write once per row. Instead, format
+        # _TidyTSVWriter.CHUNK_ROWS rows at a time and write each chunk at once.
         with self.__gql.create_file(tsv_path) as fd:
-            print('\t'.join(df.columns), file=fd)
-            for _, np_row in df.iterrows():
-                tidy_row = [_TidyTSVWriter.numpy_value_to_tidy(np_col) for np_col in np_row]
-                print('\t'.join(tidy_row), file=fd)
+            for start in range(0, max(len(df), 1), _TidyTSVWriter.CHUNK_ROWS):
+                chunk = df.iloc[start:start + _TidyTSVWriter.CHUNK_ROWS]
+                fd.write(chunk.to_csv(sep='\t', na_rep='NA', index=False, header=(start == 0),
+                                      lineterminator='\n'))
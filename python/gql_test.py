@@ -4,9 +4,9 @@
 
 import unittest
 import os.path
+import shutil
 import tempfile
 
-import numpy as np
 import pandas as pd
 
 import gql
@@ -25,7 +25,28 @@ class GQLTest(unittest.TestCase):
         self.assertEqual(df['A'][1], 2)
         self.assertEqual(df['D'][1], 1000)
         self.assertEqual(df['B'][1], 's3://a')
-        self.assertTrue(np.isnan(df['D'][2]))
+        self.assertTrue(pd.isna(df['A'][2]))
+        self.assertTrue(pd.isna(df['D'][2]))
+
+        # Comment lines after the header are skipped.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(f'{BASE_DIR}/testdata/data2.tsv') as fd:
+                lines = fd.readlines()
+            with open(f'{temp_dir}/data2.tsv', 'w') as fd:
+                fd.writelines(lines[:2] + ['# comment\n'] + lines[2:])
+            shutil.copy(f'{BASE_DIR}/testdata/data2_data_dictionary.tsv', temp_dir)
+            pd.testing.assert_frame_equal(_GQL.tidytsv_to_dataframe(f'{temp_dir}/data2.tsv'), df)
+
+    def test_read_empty_tidy_tsv(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(f'{temp_dir}/empty_data_dictionary.tsv', 'w') as fd:
+                fd.write('column_name\ttype\tdescription\nA\tint\tan int\nB\tstring\ta string\n')
+            with open(f'{temp_dir}/empty.tsv', 'w') as fd:
+                pass
+            df = _GQL.tidytsv_to_dataframe(f'{temp_dir}/empty.tsv')
+            self.assertEqual(list(df.columns), ['A', 'B'])
+            self.assertEqual(list(df.dtypes.astype(str)), ['Int64', 'string'])
+            self.assertEqual(len(df), 0)
 
     def test_write_tidy_tsv(self) -> None:
         df = _GQL.tidytsv_to_dataframe(f'{BASE_DIR}/testdata/data2.tsv')
@@ -38,6 +59,15 @@ class GQLTest(unittest.TestCase):
             print("DF2", df)
             pd.testing.assert_frame_equal(df, df2)
 
+    def test_open_tsv(self) -> None:
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.tsv') as temp_fd:
+            temp_fd.write('# comment\nA\tB\n1\tx\n# mid comment\n\n2\ty\n')
+            temp_fd.flush()
+            self.assertEqual(list(_GQL.open_tsv(temp_fd.name)), [('1', 'x'), ('2', 'y')])
+
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as temp_fd:
+            self.assertEqual(list(_GQL.open_tsv(temp_fd.name)), [])
+
     def test_file_exists(self) -> None:
         s3_path = 's3://grail-ysaito/tmp/gql_test_file_exists.txt'
         with _GQL.create_file('s3://grail-ysaito/tmp/gql_test_file_exists.txt') as temp_fd:
@@ -63,6 +93,12 @@ class GQLTest(unittest.TestCase):
         self.assertEqual([x for x in df.loc[df['patient_id'].isin(('5131', '5189'))]['primccat']],
                          ['Lung', 'Head/Neck'])
 
+    def test_eval_with_params(self) -> None:
+        df = _GQL.eval(expr='table({x: testparam0, y: testparam1})',
+                       gql_params={'testparam0': '123', 'testparam1': 'abc'})
+        self.assertEqual(df['x'][0], 123)
+        self.assertEqual(df['y'][0], 'abc')
+
     def create_file(self) -> None:
         path = 's3://grail-ysaito/tmp/gqltesttmp.txt'
         with _GQL.create_file(path) as fd:
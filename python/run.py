@@ -14,7 +14,7 @@ import logging
 import re
 import sys
 import concurrent.futures
-from typing import List
+from typing import Dict, List, Tuple
 
 import gql
 
@@ -50,20 +50,22 @@ def main() -> None:
     gql.send_mail(f'gql {args.script} started', f'Args: {sys.argv}')
 
 
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=128)
-    results: List[concurrent.futures.Future] = []
-
+    # List of (label, params) of the jobs to run.
+    jobs: List[Tuple[str, Dict[str, str]]] = []
     if args.quintile:
         for quintile in range(0, 5):
             params = dict(gql_params)
             params['quintile'] = f'{quintile}'
-            callback = lambda: gql_sess.run(label=f'{quintile}',
-                                            script_path=args.script,
-                                            gql_params=params)
-            results.append(pool.submit(callback))
+            jobs.append((f'{quintile}', params))
     else:
-        callback = lambda: gql_sess.run(label='', script_path=args.script, gql_params=gql_params)
-        results.append(pool.submit(callback))
+        jobs.append(('', gql_params))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = [pool.submit(gql_sess.run, label=label, script_path=args.script, gql_params=params)
+                   for label, params in jobs]
+        labels = {r: label for r, (label, _) in zip(results, jobs)}
+        for r in concurrent.futures.as_completed(results):
+            logging.info('Job "%s" finished with status %s', labels[r], r.result())
 
     gql_status = [r.result() for r in results]
     print(f"Jobs finished with status {gql_status}\n")
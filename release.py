@@ -9,20 +9,54 @@ The doc are installed in ./README.md and https://phabricator.grailbio.com/w/docs
 
 import argparse
 import concurrent.futures
+import functools
 import glob
+import itertools
 import json
 import logging
 import os
 import re
-import shutil
 import subprocess
-import tempfile
-import time
-from typing import List, Dict, Tuple
+from typing import Callable, Iterable, List, Dict, Tuple
 
-GRAIL = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
-                                universal_newlines=True).strip()
-GQL_DIR = os.path.join(f'{GRAIL}/go/src/grail.com/cmd/grail-query')
+@functools.lru_cache(maxsize=1)
+def grail_root() -> str:
+    """Return the root of the workspace."""
+    return subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                   universal_newlines=True).strip()
+
+def gql_dir() -> str:
+    """Return the source directory of gql."""
+    return os.path.join(f'{grail_root()}/go/src/grail.com/cmd/grail-query')
+
+RELEASE_TARGET = '//go/src/grail.com/cmd/grail-query:release'
+DOC_TOOL_TARGET = '//go/src/grail.com/cmd/grail-query/generatedoc'
+
+# A section header, "## title". Group 1 is the '#'s except the first one, group
+# 2 is the title.
+_HEADER_RE = re.compile(r'^#(#+) (.*)')
+
+# A line in a table.
+_TABLE_RE = re.compile(r'\s*\|')
+
+# Runs of characters replaced by '-' in remarkup anchors.
+_REMARKUP_ANCHOR_SPLIT_RE = re.compile(r'[\s\.:/]+')
+
+# Characters dropped from markdown anchors.
+_ANCHOR_CLEAN_RE = re.compile(r'[:/\(\)]')
+
+# Runs of characters replaced by '-' in markdown anchors.
+_ANCHOR_SPLIT_RE = re.compile(r'[\.\s]+')
+
+# Inline markups converted by Document.to_markdown. Group 1 is ::code::, and
+# groups 2 and 3 are the text and the target of [text](link).
+_MARKDOWN_TOKEN_RE = re.compile(r'::(.+?)::|\[([^]]*)\]\(([^)]*)\)')
+
+# Inline markups converted by Document.to_remarkup. Group 1 is ::code::, group
+# 2 is *bold*, group 3 is _italic_, and groups 4 and 5 are the text and the
+# target of [text](link).
+_REMARKUP_TOKEN_RE = re.compile(
+    r'::(.+?)::|\*([^*\s]+)\*|\b\_([^_\s]+)\_\b|\[([^]]*)\]\(([^)]*)\)')
 
 def call(args: List[str]) -> None:
     "Run a subprocess."
@@ -33,6 +67,13 @@ def copy_s3(src: str, dest: str) -> None:
     "Copy a file to S3"
     call(['grail-file', 'cp', src, dest])
 
+def _resolve_link(anchors: Dict[str, str], link: str) -> str:
+    """Convert a markdown-style link found in the document using a map of section
+    anchors built by Document."""
+    if link.startswith('#'):
+        return anchors[link]
+    return link
+
 class Document:
     """A helper class for annotating a markdown document and translating it into remarkup."""
 
@@ -44,43 +85,68 @@ class Document:
         self.__lines = text.split('\n')
         self.__assign_section_numbers()
 
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]) -> 'Document':
+        """Create a document from the lines of README.md, each ending with '\\n'.
+
+        Args:
+        lines: the lines of README.md, e.g., a file opened in text mode.
+        """
+        doc = cls.__new__(cls)
+        doc.__lines = []
+        line = '\n'
+        for line in lines:
+            doc.__lines.append(line[:-1] if line.endswith('\n') else line)
+        if line.endswith('\n'):
+            # Same as text.split('\n'), text that ends with '\n' has an empty last
+            # line.
+            doc.__lines.append('')
+        doc.__assign_section_numbers()
+        return doc
+
     def __assign_section_numbers(self) -> None:
         """Assign section numbers to each ### header line."""
 
-        # List of (section level, section title) in the doc
-        self.__sections: List[Tuple[int, str]] = []
+        # List of (section level, section title, markdown anchor of the title) in
+        # the doc
+        self.__sections: List[Tuple[int, str, str]] = []
 
-        # Maps markdown-style section anchors (found in the original document)
-        # to remarkup-style section anchors.
-        self.__anchor_map: Dict[str, str] = {}
+        # Map markdown-style section anchors (found in the original document) to
+        # the anchors of the numbered sections in markdown and remarkup,
+        # respectively.
+        self.__link_md: Dict[str, str] = {}
+        self.__link_rm: Dict[str, str] = {}
 
+        lines = self.__lines
+        add_section = self.__sections.append
+        link_md = self.__link_md
+        link_rm = self.__link_rm
         section_numbers = [0, 0, 0, 0, 0, 0]
-        for lineno in range(len(self.__lines)):
-            line = self.__lines[lineno]
-            m = re.match(r'^#(#+) (.*)', line)
+        for lineno, line in enumerate(lines):
+            m = _HEADER_RE.match(line)
             if not m:
                 continue
             level = len(m[1]) - 1
             section_numbers[level] += 1
             for i in range(level + 1, len(section_numbers)):
                 section_numbers[i] = 0
-            sec = ''
-            for v in section_numbers:
-                if v == 0:
-                    break
-                sec += f'{v}.'
+            # Stop at the first unset level, e.g., "### X" before any "##".
+            sec = ''.join(f'{v}.' for v in itertools.takewhile(bool, section_numbers))
             old_header = m[2]
             new_header = f'{sec} {old_header}'
-            self.__lines[lineno] = f'#{m[1]} {new_header}'
-            self.__sections.append((len(m[1]), new_header))
-            self.__anchor_map[Document.__to_markdown_hashtag(old_header)] = new_header
+            lines[lineno] = f'#{m[1]} {new_header}'
+            new_hashtag = Document.__to_markdown_hashtag(new_header)
+            add_section((len(m[1]), new_header, new_hashtag))
+            old_hashtag = Document.__to_markdown_hashtag(old_header)
+            link_md[old_hashtag] = new_hashtag
+            link_rm[old_hashtag] = Document.__to_remarkup_hashtag(new_header)
 
     @staticmethod
     def __to_remarkup_hashtag(text: str) -> str:
         """Convert section title to an implicit anchor tag using the same algorithm used
         by remarkup"""
         text = text.lower()
-        text = '#' + re.sub(r'[\s\.:/]+', '-', text)
+        text = '#' + _REMARKUP_ANCHOR_SPLIT_RE.sub('-', text)
         return text[:25]  # remarkup trims anchors at 25 bytes.
 
     @staticmethod
@@ -88,22 +154,51 @@ class Document:
         """Convert section title to an implicit anchor tag using the same algorithm used
         by markdown."""
         text = text.lower()
-        text = re.sub(r'[:/\(\)]', '', text)
-        text = '#' + re.sub(r'[\.\s]+', '-', text)
+        text = _ANCHOR_CLEAN_RE.sub('', text)
+        text = '#' + _ANCHOR_SPLIT_RE.sub('-', text)
         return text
 
-    def __generate_remarkup_link(self, link: str) -> str:
-        """Convert a markdown-style link found in the document to remarkup link"""
-        if link.startswith('#'):
-            return Document.__to_remarkup_hashtag(self.__anchor_map[link])
-        return link
+    def __line_to_markdown(self, line: str) -> str:
+        """Convert the inline markups in one line of the document to markdown. The
+        line is scanned once for all kinds of markups, and link texts are
+        converted recursively."""
+        out: List[str] = []
+        pos = 0
+        for m in _MARKDOWN_TOKEN_RE.finditer(line):
+            out.append(line[pos:m.start()])
+            if m.lastindex == 1:
+                # ::foobar:: -> `foobar`
+                out.append(f'`{m[1]}`')
+            else:
+                text = self.__line_to_markdown(m[2])
+                out.append(f'[{text}]({_resolve_link(self.__link_md, m[3])})')
+            pos = m.end()
+        out.append(line[pos:])
+        return ''.join(out)
 
-    def __generate_markdown_link(self, link: str) -> str:
-        """Convert a markdown-style link found in the document to a link w/ section
-        numbers."""
-        if link.startswith('#'):
-            return Document.__to_markdown_hashtag(self.__anchor_map[link])
-        return link
+    def __line_to_remarkup(self, line: str) -> str:
+        """Convert the inline markups in one line of the document to remarkup. The
+        line is scanned once for all kinds of markups, and the contents of bold,
+        italic, and link texts are converted recursively. The contents of
+        ::code:: are not."""
+        out: List[str] = []
+        pos = 0
+        for m in _REMARKUP_TOKEN_RE.finditer(line):
+            out.append(line[pos:m.start()])
+            kind = m.lastindex
+            if kind == 1:
+                # ::foobar:: -> `foobar`
+                out.append(f'`{m[1]}`')
+            elif kind in (2, 3):
+                # *foobar* or _foobar_ -> //foobar//
+                out.append(f'//{self.__line_to_remarkup(m[kind])}//')
+            else:
+                # [text](link) -> [[link|text]]
+                text = self.__line_to_remarkup(m[4])
+                out.append(f'[[{_resolve_link(self.__link_rm, m[5])}|{text}]]')
+            pos = m.end()
+        out.append(line[pos:])
+        return ''.join(out)
 
     def to_markdown(self) -> str:
         """Convert the document to a prettier markdown format"""
@@ -115,63 +210,57 @@ class Document:
                     # Generate TOC just before the first non-title section.
                     out.append('## Table of contents') # empty line
                     out.append('')
-                    for level, title in self.__sections:
+                    for level, title, hashtag in self.__sections:
                         indent = ' ' * 2 * (level-1)
-                        out.append(indent + f'* [{title}]({Document.__to_markdown_hashtag(title)})')
+                        out.append(indent + f'* [{title}]({hashtag})')
                     out.append('')
                     generated_toc = True
             else:
-                line = re.sub(r'::(.+?)::', r'`\1`', line)
-                line = re.sub(r'\[([^]]*)\]\(([^)]*)\)',
-                              lambda m: f'[{m[1]}]({self.__generate_markdown_link(m[2])})', line)
+                line = self.__line_to_markdown(line)
 
             out.append(line)
         return '\n'.join(out)
 
     def to_remarkup(self) -> str:
         """Convert the document to Phabricator remarkup format"""
-        out = ''
+        out: List[str] = []
         prev_line = ''
         for line in self.__lines:
-            line = re.sub(r'::(.+?)::', r'`\1`', line)
-            # *foobar* -> //foobar//
-            line = re.sub(r'\*([^*\s]+)\*', r'//\1//', line)
-            # _foobar_ -> //foobar//
-            line = re.sub(r'\b\_([^_\s]+)\_\b', r'//\1//', line)
-            # [text](link) -> [[link|text]]
-            line = re.sub(r'\[([^]]*)\]\(([^)]*)\)',
-                          lambda m: f'[[{self.__generate_remarkup_link(m[2])}|{m[1]}]]', line)
+            line = self.__line_to_remarkup(line)
 
             # Convert line endings. Markdown treats an empty line as a paragraph
             # delimiter, whereas remarkup treats a newline as a paragraph delimiter.
             # So here we remove the '\n', except for pre-formatted text blocks or
             # empty lines.
             if line == '':
-                out += line + '\n'
+                out.append(line + '\n')
                 if prev_line != '':
-                    out += '\n'
-            elif re.match(r'\s*\|', line) or line.startswith('    ') or line.startswith('- '):
-                out += line + '\n' # table or codeblock
+                    out.append('\n')
+            elif _TABLE_RE.match(line) or line.startswith('    ') or line.startswith('- '):
+                out.append(line + '\n') # table or codeblock
             else:
                 if prev_line != '':
-                    out += ' '
-                out += line
+                    out.append(' ')
+                out.append(line)
             prev_line = line
-        return out
+        return ''.join(out)
 
 
 
 def install_doc() -> None:
-    """Generate README.md and push it to the phabricator wiki page."""
-    call(['bazel', 'build', '//go/src/grail.com/cmd/grail-query/generatedoc'])
-    generatedoc_path = glob.glob(f'{GRAIL}/bazel-bin/go/src/grail.com/cmd/grail-query/generatedoc/*/generatedoc')[0]
+    """Generate README.md and push it to the phabricator wiki page. DOC_TOOL_TARGET
+    must have been built already."""
+    generatedoc_path = glob.glob(f'{grail_root()}/bazel-bin/go/src/grail.com/cmd/grail-query/generatedoc/*/generatedoc')[0]
     logging.info("call: %s", generatedoc_path)
-    readme = Document(subprocess.check_output(
-        [generatedoc_path],
-        cwd=f'{GRAIL}/go/src/grail.com/cmd/grail-query',
-        universal_newlines=True))
+    with subprocess.Popen([generatedoc_path],
+                          cwd=gql_dir(),
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True) as proc:
+        readme = Document.from_lines(proc.stdout)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
-    with open(f'{GQL_DIR}/README.md', 'w') as fd:
+    with open(f'{gql_dir()}/README.md', 'w') as fd:
         # Note: ToC is needed only for markdown. The Phabricator wiki server
         # automatically adds a navigation menu.
         #fd.write(generate_toc(readme))
@@ -183,23 +272,21 @@ def install_doc() -> None:
         "title" : "GQL",
         "content": data,
     }
-    log_fd = open('/tmp/arclog.txt', 'w')
-    with tempfile.NamedTemporaryFile(mode='w+') as temp_fd:
-        temp_fd.write(json.dumps(js_text, indent=2))
-        temp_fd.seek(0)
-        subprocess.check_call(['arc', 'call-conduit',
-                               '--conduit-uri', 'https://phabricator.grailbio.com/',
-                               'phriction.edit'],
-                              stdin=temp_fd,
-                              stdout=log_fd,
-                              stderr=subprocess.STDOUT)
+    with open('/tmp/arclog.txt', 'wb', buffering=0) as log_fd:
+        subprocess.run(['arc', 'call-conduit',
+                        '--conduit-uri', 'https://phabricator.grailbio.com/',
+                        'phriction.edit'],
+                       input=json.dumps(js_text).encode(),
+                       stdout=log_fd,
+                       stderr=subprocess.STDOUT,
+                       check=True)
 
 def main() -> None:
     """Main entry point."""
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)-15s %(message)s')
-    logging.info('Workspace root is "%s"', GRAIL)
+    logging.info('Workspace root is "%s"', grail_root())
     parser = argparse.ArgumentParser()
     parser.add_argument('--skip-release',
                         action='store_true',
@@ -208,18 +295,30 @@ def main() -> None:
                         action='store_true',
                         help="""Don't copy doc in Phabricator wiki""")
     args = parser.parse_args()
-    os.chdir(GRAIL)
+    os.chdir(grail_root())
 
-    # Install binaries and docs.
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=128)
-    results = []
+    targets = []
     if not args.skip_release:
-        results.append(pool.submit(call, ['bazel', 'run', '//go/src/grail.com/cmd/grail-query:release']))
+        targets.append(RELEASE_TARGET)
     if not args.skip_doc:
-        results.append(pool.submit(install_doc))
+        targets.append(DOC_TOOL_TARGET)
+    if not targets:
+        return
+    # Build the release binaries and the doc tool in one invocation. Bazel runs
+    # one command at a time in a workspace, so separate builds would not
+    # overlap.
+    call(['bazel', 'build'] + targets)
 
-    # Wait for the threads to finish.
-    for result in results:
-        result.result()
+    # Install binaries and docs.
+    tasks: List[Callable[[], None]] = []
+    if not args.skip_release:
+        tasks.append(lambda: call(['bazel', 'run', RELEASE_TARGET]))
+    if not args.skip_doc:
+        tasks.append(install_doc)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        # Report failures in the order they happen.
+        for result in concurrent.futures.as_completed([pool.submit(t) for t in tasks]):
+            result.result()
 
-main()
+if __name__ == '__main__':
+    main()